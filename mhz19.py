@@ -1,7 +1,11 @@
+import micropython
 from machine import UART
 from time import sleep
 
 
+_READ_CO2_FRAME = b'\xff\x01\x86\x00\x00\x00\x00\x00\x79'
+
+
 class MHZ19ChecksumError(Exception):
     def __init__(self):
         super().__init__('mhz19: checksum error')
@@ -9,6 +13,9 @@ class MHZ19ChecksumError(Exception):
 class MHZ19:
     def __init__(self, rx_pin: int, tx_pin: int):
         self.uart = UART(2, baudrate=9600, rx=rx_pin, tx=tx_pin, timeout=100)
+        # Responses are read into this buffer, which is reused for every command.
+        self._rx = bytearray(9)
+        self._rxv = memoryview(self._rx)
 
     def close(self):
         try:
@@ -24,28 +31,38 @@ class MHZ19:
         ])
         req_bytes += cmd_data
         req_bytes += bytes([0] * (8 - len(req_bytes)))
-        req_bytes += bytes([MHZ19._checksum(req_bytes[1:])])
+        req_bytes += bytes([_checksum(memoryview(req_bytes)[1:], 7)])
         assert len(req_bytes) == 9
 
         bytes_written = self.uart.write(req_bytes)
         assert bytes_written is not None
         if resp_len == 0:
             return
+        return self._recv(resp_len)
 
-        resp_bytes = self.uart.read(resp_len)
-        if len(resp_bytes) != resp_len:
-            raise Exception('mhz19: not enough bytes received: %d' % len(resp_bytes))
-        if resp_bytes[-1] != MHZ19._checksum(resp_bytes[1:-1]):
+    def _recv(self, resp_len: int):
+        # The returned view is only valid until the next command.
+        n = self.uart.readinto(self._rx, resp_len) or 0
+        if n != resp_len:
+            raise Exception('mhz19: not enough bytes received: %d' % n)
+        if self._rx[resp_len-1] != _checksum(self._rxv[1:resp_len-1], resp_len-2):
             raise MHZ19ChecksumError()
-        return resp_bytes[2:]
+        return self._rxv[2:resp_len]
 
     def gas_concentration(self) -> int:
-        resp = self._cmd(0x86, bytes(), 9)
-        return resp[0]<<8 | resp[1]
+        # Equivalent to self._cmd(0x86, bytes(), 9), but without building the request.
+        bytes_written = self.uart.write(_READ_CO2_FRAME)
+        assert bytes_written is not None
+        self._recv(9)
+        return self._rx[2]<<8 | self._rx[3]
+
 
-    @staticmethod
-    def _checksum(data: bytes) -> int:
-        return ((0xff - sum(data) & 0xff) + 1) & 0xff
+@micropython.viper
+def _checksum(data: ptr8, n: int) -> int:
+    s = 0
+    for i in range(n):
+        s += data[i]
+    return ((0xff - (s & 0xff)) + 1) & 0xff
 
-assert MHZ19._checksum(b'\x01\x86\x00\x00\x00\x00\x00') == 0x79
-assert MHZ19._checksum(b'\x86\x01\x9a<\x00\x00\x00') == 0xa3
+assert _checksum(memoryview(_READ_CO2_FRAME)[1:-1], 7) == _READ_CO2_FRAME[-1]
+assert _checksum(b'\x86\x01\x9a<\x00\x00\x00', 7) == 0xa3
@@ -0,0 +1,419 @@
+from array import array
+import display
+import micropython
+from math import ceil
+from ustruct import pack_into
+import utime
+
+
+# The screen size and font metrics never change, measure them once.
+DISPLAY_W, DISPLAY_H = display.size()
+TEXT_H = display.getTextHeight('-')
+CO2_LABEL_FONT = 'permanentmarker22'
+CO2_LABEL_H = display.getTextHeight('CO2: 0', CO2_LABEL_FONT)
+
+
+DISPLAY_LIST_LINE = const(1)
+DISPLAY_LIST_PIXEL = const(2)
+
+
+@micropython.viper
+def display_list_replay(buf: ptr16, n: int):
+    # Each command is 5 int16s: [op | gray<<8, x0, y0, x1, y1].
+    for i in range(n):
+        r = i * 5
+        op = buf[r] & 0xff
+        color = (buf[r] >> 8) * 0x010101
+        # Sign extend the coordinates.
+        x0 = (buf[r+1] ^ 0x8000) - 0x8000
+        y0 = (buf[r+2] ^ 0x8000) - 0x8000
+        if op == DISPLAY_LIST_LINE:
+            x1 = (buf[r+3] ^ 0x8000) - 0x8000
+            y1 = (buf[r+4] ^ 0x8000) - 0x8000
+            display.drawLine(x0, y0, x1, y1, color)
+        elif op == DISPLAY_LIST_PIXEL:
+            display.drawPixel(x0, y0, color)
+
+
+class DisplayList:
+    """Records line and pixel draw commands into a bytearray to be replayed in one go.
+
+    Colors are stored as a single gray level, which is all the badge display can show. line()
+    and pixel() are meant for cold paths, hot loops should write records into buf directly.
+    """
+
+    def __init__(self, capacity):
+        self.buf = bytearray(10*capacity)
+        self.n = 0
+
+    def reserve(self, n):
+        """Makes room for n more commands, for code that writes records into buf directly."""
+        missing = 10*(self.n+n) - len(self.buf)
+        if missing > 0:
+            self.buf.extend(bytes(max(missing, len(self.buf))))
+
+    def line(self, x0, y0, x1, y1, color=0x000000):
+        self.reserve(1)
+        pack_into('<Hhhhh', self.buf, 10*self.n, DISPLAY_LIST_LINE | (color&0xff)<<8, x0, y0, x1, y1)
+        self.n += 1
+
+    def pixel(self, x, y, color=0x000000):
+        self.reserve(1)
+        pack_into('<Hhhhh', self.buf, 10*self.n, DISPLAY_LIST_PIXEL | (color&0xff)<<8, x, y, 0, 0)
+        self.n += 1
+
+    def extend(self, other):
+        self.reserve(other.n)
+        self.buf[10*self.n:10*(self.n+other.n)] = memoryview(other.buf)[:10*other.n]
+        self.n += other.n
+
+    def flush(self):
+        """Draws and clears all recorded commands."""
+        display_list_replay(self.buf, self.n)
+        self.n = 0
+
+
+display_list = DisplayList(512)
+
+
+# Scratch space for building labels without going through the generic string formatting.
+_fmt_buf = bytearray(32)
+
+
+def _fmt_bytes(buf, off, b):
+    buf[off:off+len(b)] = b
+    return off + len(b)
+
+
+@micropython.native
+def _fmt_int(buf, off, n):
+    """Writes n in decimal to buf at off and returns the offset past the last digit."""
+    if n < 0:
+        buf[off] = 0x2d  # '-'
+        off += 1
+        n = -n
+    start = off
+    while True:
+        buf[off] = 0x30 + n % 10
+        off += 1
+        n //= 10
+        if n == 0:
+            break
+    # The digits were written least significant first.
+    end = off - 1
+    while start < end:
+        buf[start], buf[end] = buf[end], buf[start]
+        start += 1
+        end -= 1
+    return off
+
+
+@micropython.native
+def _fmt_fixed2(buf, off, x):
+    """Writes x with two decimals to buf at off, like '{:.2f}', and returns the offset past it."""
+    n = int(round(x * 100))
+    if n < 0:
+        buf[off] = 0x2d  # '-'
+        off += 1
+        n = -n
+    off = _fmt_int(buf, off, n // 100)
+    frac = n % 100
+    buf[off] = 0x2e  # '.'
+    buf[off+1] = 0x30 + frac // 10
+    buf[off+2] = 0x30 + frac % 10
+    return off + 3
+
+
+def cached_text_width(cache, key, label, *font):
+    """Returns the width of label, measuring it only if key is not in cache yet.
+
+    Keying numeric labels on their length assumes all digits are equally wide.
+    """
+    label_w = cache.get(key)
+    if label_w is None:
+        label_w = cache[key] = display.getTextWidth(label, *font)
+    return label_w
+
+
+def format_int(n, prefix=b'', suffix=b''):
+    off = _fmt_bytes(_fmt_buf, 0, prefix)
+    off = _fmt_int(_fmt_buf, off, int(n))
+    off = _fmt_bytes(_fmt_buf, off, suffix)
+    return str(memoryview(_fmt_buf)[:off], 'ascii')
+
+
+@micropython.native
+def clear_rect(rect):
+    x, y, w, h = rect
+    display.drawRect(x, y, w, h, True, 0xffffff)
+
+@micropython.native
+def draw_dashed_line(x0, y0, x1, y1, color=0x000000, space=12, dl=None):
+    if dl is None:
+        dl = display_list
+    dx, dy = x1-x0, y1-y0
+    l = max(abs(dx), abs(dy))
+    if l > 0:
+        # Per-pixel step along the line in 16.16 fixed point.
+        sx, sy = (dx << 16) // l, (dy << 16) // l
+        half = space // 2
+        for d in range(0, l, space):
+            e = min(d + half, l)
+            dl.line(
+                x0 + (d*sx >> 16), y0 + (d*sy >> 16),
+                x0 + (e*sx >> 16), y0 + (e*sy >> 16),
+                color)
+    dl.pixel(x1, y1, color)
+
+
+@micropython.viper
+def ring_put(buf: ptr16, i: int, sample: int):
+    buf[i] = sample
+
+
+@micropython.viper
+def ring_minmax(buf: ptr16, n: int) -> uint:
+    sample_min = 0xffff
+    sample_max = 0
+    for i in range(n):
+        sample = buf[i]
+        if sample < sample_min:
+            sample_min = sample
+        if sample > sample_max:
+            sample_max = sample
+    return uint((sample_min << 16) | sample_max)
+
+
+@micropython.viper
+def ring_plot(buf: ptr16, out: ptr16, params: ptr32):
+    # Viper functions take at most four arguments, so the plot geometry is passed in as
+    # [start, n, size, x, y, w, h, sample_min, scale, out_i], with scale being h/(max-min) in
+    # 16.16 fixed point. The n-1 line segments are written as display list commands into out,
+    # starting at int16 index out_i.
+    i = params[0]
+    n = params[1]
+    size = params[2]
+    x = params[3]
+    y = params[4]
+    w = params[5]
+    h = params[6]
+    sample_min = params[7]
+    scale = params[8]
+    r = params[9]
+
+    px = x + w - n
+    py = y + h - (((buf[i] - sample_min) * scale) >> 16) - 1
+    for _ in range(n-1):
+        i += 1
+        if i >= size:
+            i = 0
+        nx = px + 1
+        ny = y + h - (((buf[i] - sample_min) * scale) >> 16) - 1
+        out[r] = DISPLAY_LIST_LINE  # Black.
+        out[r+1] = px
+        out[r+2] = py
+        out[r+3] = nx
+        out[r+4] = ny
+        r += 5
+        px = nx
+        py = ny
+
+
+class History:
+    """Fixed size ring buffer of uint16 samples.
+
+    The samples are stored in a bytearray so they can be walked as a ptr16 from viper code
+    without boxing each one.
+    """
+
+    def __init__(self, size):
+        self.buf = bytearray(2*size)
+        self.size = size
+        self.head = 0  # Index the next sample is written to.
+        self.len = 0
+        # Incremented on every append, so changes can be detected without walking the samples.
+        self.version = 0
+
+    def append(self, sample):
+        ring_put(self.buf, self.head, min(max(int(sample), 0), 0xffff))
+        self.head = (self.head+1) % self.size
+        self.len = min(self.len+1, self.size)
+        self.version += 1
+
+    def start(self):
+        """Returns the index of the oldest sample."""
+        return (self.head - self.len) % self.size
+
+    def minmax(self):
+        r = ring_minmax(self.buf, self.len)
+        return r >> 16, r & 0xffff
+
+
+def draw_history_graph_plot(rect, history):
+    x, y, w, h = rect
+
+    n = min(w, history.len)
+    if n < 2:
+        return
+
+    sample_min, sample_max = history.minmax()
+    start = (history.start() + history.len - n) % history.size
+    scale = (h << 16) // max(sample_max-sample_min, 1)
+    display_list.reserve(n-1)
+    params = array('i', [start, n, history.size, x, y, w, h, sample_min, scale, 5*display_list.n])
+    ring_plot(history.buf, display_list.buf, params)
+    display_list.n += n-1
+
+
+def draw_history_graph_axes(rect, x_axis_labels, x_label_h, dl):
+    x, y, w, h = rect
+    draw_dashed_line(x, y, x+w-1, y, 0x000000, dl=dl)
+    draw_dashed_line(x, y+h-1 - x_label_h, x+w-1, y+h-1 - x_label_h, 0x000000, dl=dl)
+    for sample_offset in x_axis_labels:
+        lx = x + w - sample_offset
+        if lx > DISPLAY_W:
+            continue
+        draw_dashed_line(lx, y, lx, y+h-1 - x_label_h, 0x000000, dl=dl)
+
+
+def draw_history_graph(rect, history, x_axis_labels, axis_cache):
+    x, y, w, h = rect
+    clear_rect(rect)
+
+    txt_h = TEXT_H + 2
+    x_label_h = txt_h
+
+    sample_min, sample_max = history.minmax()
+    display.drawText(x, y, format_int(sample_max, suffix=b'ppm'), 0x000000)
+    display.drawText(x, y-txt_h+h - x_label_h, format_int(sample_min, suffix=b'ppm'), 0x000000)
+
+    # The axes only move when the labels do, so their dashed lines are recorded once and
+    # copied from the cache on subsequent paints. history_timestamps returns the same dict for as
+    # long as the labels are unchanged, so the labels are compared by identity. The cached entry
+    # holds on to the dict, so its id can not be reused by another one.
+    key = (rect, id(x_axis_labels))
+    entry = axis_cache.get(key)
+    if entry is None or entry[0] is not x_axis_labels:
+        axes = DisplayList(128)
+        draw_history_graph_axes(rect, x_axis_labels, x_label_h, axes)
+        axis_cache.clear()
+        entry = axis_cache[key] = (x_axis_labels, axes)
+    display_list.extend(entry[1])
+
+    for sample_offset, label in x_axis_labels.items():
+        lx = x + w - sample_offset
+        if lx > DISPLAY_W:
+            continue
+        display.drawText(lx, y+h-txt_h, label)
+
+    draw_history_graph_plot((x, y, w, h - x_label_h), history)
+
+
+_co2_label_widths = {}
+
+@micropython.native
+def draw_co2_label(rect, co2):
+    x, y, w, h = rect
+    clear_rect(rect)
+
+    co2_label = format_int(co2, prefix=b'CO2: ')
+    co2_label_w = cached_text_width(_co2_label_widths, len(co2_label), co2_label, CO2_LABEL_FONT)
+    display.drawText(x + w//2 - co2_label_w//2, y + h//2 - CO2_LABEL_H//2,
+                     co2_label, 0x000000, CO2_LABEL_FONT)
+
+
+_climate_label_widths = {}
+
+@micropython.native
+def draw_climate_labels(rect, temperature, pressure, humidity):
+    x, y, w, h = rect
+    clear_rect(rect)
+
+    off = _fmt_fixed2(_fmt_buf, 0, temperature)
+    off = _fmt_bytes(_fmt_buf, off, b'C  ')
+    off = _fmt_fixed2(_fmt_buf, off, humidity)
+    off = _fmt_bytes(_fmt_buf, off, b'%')
+    label = str(memoryview(_fmt_buf)[:off], 'ascii')
+    label_w = cached_text_width(_climate_label_widths, len(label), label)
+    display.drawText(x + w//2 - label_w//2, y + h//2 - TEXT_H//2, label, 0x000000)
+
+
+_message_label_widths = {}
+
+def draw_message_label(pos, label):
+    if not label:
+        return
+    center_x, center_y = pos
+    padding = 4
+    label_w, label_h = cached_text_width(_message_label_widths, label, label), TEXT_H+4
+    area_x, area_y = center_x - label_w//2 - padding, center_y - label_h//2 - padding
+    display.drawRect(area_x, area_y, label_w+padding*2, label_h+padding*2, True, 0)
+    display.drawText(area_x+padding, area_y+padding, label, 0xffffff)
+
+
+class UI:
+    def __init__(self):
+        self.co2 = None
+        self.co2_history_version = None
+        self.timestamps = None
+        self.climate = None
+        self.message = ''
+        self._axis_cache = {}
+        display.drawFill(0xffffff)  # Clear
+
+    def draw(self, co2, co2_history, timestamps, climate, message):
+        w, h = DISPLAY_W, DISPLAY_H
+        co2_history_version = co2_history.version
+        repaint = False
+        if co2 != self.co2:
+            draw_co2_label((0, 0, int(w*(2/5)), h//4), co2)
+            repaint = True
+        if climate != self.climate:
+            temperature, pressure, humidity = climate
+            draw_climate_labels((int(w*(3/5)), 0, int(w*(2/5)), h//4), temperature, pressure, humidity)
+            repaint = True
+        if co2_history_version != self.co2_history_version or timestamps != self.timestamps or message != self.message:
+            graph_rect = (0, h//4, w, h//4*3)
+            draw_history_graph(graph_rect, co2_history, timestamps, self._axis_cache)
+            # The message is drawn on top of the graph.
+            display_list.flush()
+            draw_message_label((w//2, graph_rect[1] + graph_rect[3]//2), message)
+            repaint = True
+        if repaint:
+            display_list.flush()
+            display.flush()
+
+        # Cache rendered values so we can prevent repainting parts of the screen.
+        self.co2 = co2
+        self.co2_history_version = co2_history_version
+        self.timestamps = timestamps
+        self.climate = climate
+        self.message = message
+
+
+_history_timestamps_cache = (None, None)
+
+@micropython.native
+def history_timestamps(rate, max_sample_index):
+    global _history_timestamps_cache
+    (year, _, _, now_h, now_m, now_s, _, _) = utime.localtime()
+    now_s += now_m * 60
+
+    reltime = year < 2020  # If NTP is not synced, fall back to relative time offsets.
+    if reltime:
+        now_h, now_s = 0, 0
+
+    offset = now_s // rate
+    # The labels only move when the offset does, which is once every rate seconds at most.
+    key = (rate, max_sample_index, reltime, now_h, offset)
+    if key == _history_timestamps_cache[0]:
+        return _history_timestamps_cache[1]
+
+    labels = {}
+    for i in range(ceil(max_sample_index / (3600/rate))):
+        h = now_h-i if reltime else (now_h-i + 24) % 24
+        half_h = h+1 if reltime else h
+        labels[offset + 3600//rate * i - 1800//rate] = format_int(half_h, suffix=b':30')
+        labels[offset + 3600//rate * i] = format_int(h, suffix=b':00')
+    _history_timestamps_cache = (key, labels)
+    return labels